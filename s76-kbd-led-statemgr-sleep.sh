@@ -0,0 +1,11 @@
+#!/bin/sh
+# systemd-suspend.service hook that hands off to the socket-activated daemon
+
+case "$1" in
+pre) command=P ;;
+post) command=p ;;
+*) exit 0 ;;
+esac
+
+reply=$(printf '%s' "$command" | socat -t 10 - UNIX-CONNECT:/run/s76-kbd-led-statemgr.sock) || exit 1
+[ "$reply" = "0" ]
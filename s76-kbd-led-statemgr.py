@@ -1,16 +1,37 @@
 #!/usr/bin/env python3
 
-import argparse
-import json
-import pathlib
-import re
+import functools
+import os
+import socket
+import sys
 
+VALID_BRIGHTNESS = frozenset(str(i) for i in range(256))
+VALID_COLORS = frozenset(r + g + b for r in ("00", "FF") for g in ("00", "FF") for b in ("00", "FF"))
 
+# state directories already created by this process
+state_dirs_ready = set()
+
+
+@functools.lru_cache(maxsize=4)
+def load_state_cached(path: str, mtime_ns: int) -> dict:
+    # mtime_ns is only part of the cache key, so a rewritten file is parsed again
+    with open(path, "rb") as state_file:
+        data = state_file.read()
+    if data.startswith(b"{"):
+        # legacy json state, replaced by the text format on the next write
+        import json
+
+        return json.loads(data)
+    brightness, color = data.decode("ascii").splitlines()
+    return {"brightness": brightness, "color": color}
+
+
+@functools.cache
 def read_configuration() -> dict:
-    configuration_paths = [
-        pathlib.PosixPath("/usr/local/etc/s76-kbd-led-statemgr.json"),
-        pathlib.PosixPath("/etc/s76-kbd-led-statemgr.json"),
-    ]
+    configuration_paths = (
+        "/usr/local/etc/s76-kbd-led-statemgr.json",
+        "/etc/s76-kbd-led-statemgr.json",
+    )
     default_config = {
         "brightness": {
             "path": "/sys/class/leds/system76_acpi::kbd_backlight/brightness",
@@ -20,14 +41,19 @@ def read_configuration() -> dict:
             "path": "/sys/class/leds/system76_acpi::kbd_backlight/color",
             "default": "FF0000",
         },
-        "state_path": "/var/lib/s76-kbd-led-statemgr/state.json",
+        "state_path": "/var/lib/s76-kbd-led-statemgr/state.txt",
     }
     configuration = None
     for config_path in configuration_paths:
+        if not os.path.isfile(config_path):
+            continue
+        # only needed when a configuration file exists
+        import json
+
         # noinspection PyBroadException
         try:
-            with open(config_path, "rt") as config_file:
-                configuration = json.load(config_file)
+            with open(config_path, "rb") as config_file:
+                configuration = json.loads(config_file.read())
             break
         except Exception:
             pass
@@ -43,44 +69,85 @@ def read_state(configuration: dict) -> dict:
     default_brightness = configuration["brightness"]["default"]
     default_color = configuration["color"]["default"]
     state_path = configuration["state_path"]
+    if not os.path.exists(state_path):
+        # one-shot migration from the state file of older versions
+        state_path = os.path.join(os.path.dirname(state_path), "state.json")
     # noinspection PyBroadException
     try:
-        with open(state_path, "rt") as state_file:
-            state = json.load(state_file)
-            if not 0 <= int(state["brightness"]) <= 255:
-                state["brightness"] = default_brightness
-            if not re.fullmatch(r"^(00|FF){3}$", state["color"]):
-                state["brightness"] = default_color
+        # copy, the cached object must not be modified
+        state = dict(load_state_cached(state_path, os.stat(state_path).st_mtime_ns))
+        if state["brightness"] not in VALID_BRIGHTNESS:
+            state["brightness"] = default_brightness
+        if state["color"] not in VALID_COLORS:
+            state["color"] = default_color
     except Exception:
         state = {"brightness": default_brightness, "color": default_color}
+    # exactly what apply_state writes to sysfs, never persisted
+    state["_brightness_payload"] = (state["brightness"] + "\n").encode("ascii")
+    state["_color_payload"] = (state["color"] + "\n").encode("ascii")
     return state
 
 
 def write_state(configuration: dict, state: dict):
     state_path = configuration["state_path"]
-    pathlib.PosixPath(state_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(state_path, "wt") as out_file:
-        json.dump(state, out_file, indent=2)
-        out_file.write("\n")
+    state_dir = os.path.dirname(state_path) or "."
+    if state_dir not in state_dirs_ready:
+        os.makedirs(state_dir, exist_ok=True)
+        state_dirs_ready.add(state_dir)
+    # write beside the real file, fsync, then rename over it, so neither
+    # an interrupted write nor a power loss leaves a truncated state file
+    tmp_path = state_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as out_file:
+            out_file.write(f"{state['brightness']}\n{state['color']}\n".encode("ascii"))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, state_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
     return
 
 
+def read_value(path: str) -> str:
+    # attribute values are a few bytes, one read(2) gets all of them
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, 32)
+    finally:
+        os.close(fd)
+    return data.strip().decode("ascii")
+
+
+def write_value(path: str, payload: bytes) -> None:
+    # one write(2) per attribute, each sysfs write is an EC transaction
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, payload)
+    finally:
+        os.close(fd)
+
+
 def apply_state(configuration: dict, state: dict):
     brightness_path = configuration["brightness"]["path"]
     color_path = configuration["color"]["path"]
-    with open(brightness_path, "at") as brightness_file:
-        brightness_file.write(state["brightness"] + "\n")
-    with open(color_path, "at") as color_file:
-        color_file.write(state["color"] + "\n")
+    # skip writes that would not change anything, they are not free
+    if read_value(brightness_path) != state["brightness"]:
+        write_value(brightness_path, state["_brightness_payload"])
+    if read_value(color_path) != state["color"]:
+        write_value(color_path, state["_color_payload"])
 
 
 def do_pre(configuration: dict) -> None:
-    with open(configuration["brightness"]["path"], "rt") as brightness_file:
-        brightness = brightness_file.readline().strip()
-        check_valid_str(brightness, source=brightness_file.name)
-    with open(configuration["color"]["path"], "rt") as color_file:
-        color = color_file.readline().strip()
-        check_valid_str(color, source=color_file.name)
+    brightness_path = configuration["brightness"]["path"]
+    color_path = configuration["color"]["path"]
+    brightness = read_value(brightness_path)
+    check_valid_str(brightness, source=brightness_path)
+    color = read_value(color_path)
+    check_valid_str(color, source=color_path)
     write_state(configuration, {"brightness": brightness, "color": color})
 
 
@@ -89,24 +156,67 @@ def do_post(configuration: dict) -> None:
     apply_state(configuration, state)
 
 
+def sd_notify(message: bytes) -> None:
+    notify_socket = os.environ.get("NOTIFY_SOCKET")
+    if not notify_socket:
+        return
+    if notify_socket.startswith("@"):
+        notify_socket = "\0" + notify_socket[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+        notify.sendto(message, notify_socket)
+
+
+def serve(configuration: dict) -> None:
+    # systemd socket activation passes the listening socket as fd 3
+    if os.environ.get("LISTEN_PID") != str(os.getpid()) or os.environ.get("LISTEN_FDS") != "1":
+        raise RuntimeError("serve must be started through a systemd socket unit")
+    handlers = {b"P": do_pre, b"p": do_post}
+    with socket.socket(fileno=3) as listener:
+        sd_notify(b"READY=1")
+        while True:
+            connection, _ = listener.accept()
+            with connection:
+                # a client that never sends must not block later suspends
+                connection.settimeout(5)
+                try:
+                    command = connection.recv(1)
+                except OSError:
+                    continue
+                if not command:
+                    continue
+                handler = handlers.get(command)
+                # noinspection PyBroadException
+                try:
+                    if handler is None:
+                        raise ValueError("Invalid command")
+                    handler(configuration)
+                    reply = b"0"
+                except Exception as exc:
+                    print(f"{type(exc).__name__}: {exc}", file=sys.stderr, flush=True)
+                    reply = b"1"
+                # the client may have given up already, that must not end the loop
+                try:
+                    connection.sendall(reply)
+                except OSError:
+                    pass
+
+
 def main():
-    parser = argparse.ArgumentParser(
-        description="https://github.com/draeath/s76-kbd-led-statemgr/blob/master/README.md",
-    )
-    parser.add_argument(
-        "transition",
-        type=str,
-        help="The [pre|post] keyword from systemd-suspend.service",
-    )
-    args = parser.parse_known_args()[0]
-    if args.transition not in ["pre", "post"]:
-        raise ValueError(f"Invalid argument '{args.transition}'")
+    # additional arguments from systemd-suspend.service are ignored
+    if len(sys.argv) < 2 or sys.argv[1] not in ("pre", "post", "serve"):
+        sys.exit(
+            f"usage: {os.path.basename(sys.argv[0])} pre|post|serve\n"
+            "https://github.com/draeath/s76-kbd-led-statemgr/blob/master/README.md"
+        )
+    transition = sys.argv[1]
     configuration = read_configuration()
 
-    if args.transition == "pre":
+    if transition == "pre":
         do_pre(configuration)
-    elif args.transition == "post":
+    elif transition == "post":
         do_post(configuration)
+    elif transition == "serve":
+        serve(configuration)
 
 
 if __name__ == "__main__":